@@ -2,115 +2,292 @@
 Minimal Skyframe: restart-based evaluation with signaling
 """
 
+from collections import deque
+
 # ============================================================================
 # Core Framework
 # ============================================================================
 
+_PENDING = object()  # node value placeholder until compute() succeeds
+
+
 class Graph:
     def __init__(self):
-        self.nodes = {}        # key -> value (None if not done)
+        self.nodes = {}        # key -> value (_PENDING if not done)
         self.reverse_deps = {}  # key -> set of parent keys
+        self.direct_deps = {}   # key -> set of deps requested by latest compute()
         self.waiting_on = {}    # key -> count of unsignaled deps
-        self.in_flight = set()  # keys currently being evaluated
+        self.memo = {}          # invalidated key -> (value, ((dep_key, dep_value), ...))
+        self.in_flight = set()  # keys queued or waiting on deps (dedupes the queue)
 
     def get_or_create(self, key):
         if key not in self.nodes:
-            self.nodes[key] = None
+            self.nodes[key] = _PENDING
             self.reverse_deps[key] = set()
+            self.direct_deps[key] = set()
             self.waiting_on[key] = 0
-        return self.nodes.get(key)
+        value = self.nodes[key]
+        return None if value is _PENDING else value
 
     def is_done(self, key):
-        return key in self.nodes and self.nodes[key] is not None
+        return self.nodes.get(key, _PENDING) is not _PENDING
 
 
 class Environment:
     """Provided to compute() - tracks missing deps"""
-    def __init__(self, graph, queue, current_key):
+    __slots__ = ("_graph", "_queue", "_key", "_inline", "_new_dep_count")
+
+    def __init__(self, graph, queue, current_key, inline=None):
         self._graph = graph
         self._queue = queue
         self._key = current_key
-        self._missing = False
-        self._new_deps = []
+        self._inline = inline  # evaluates a pending, not-in-flight dep in place (one level)
+        self._new_dep_count = 0
+
+    def reset(self, current_key):
+        """Reuses this Environment for another compute() call"""
+        self._key = current_key
+        self._new_dep_count = 0
 
     def get_value(self, dep_key):
-        self._graph.get_or_create(dep_key)
+        """Returns the dep's value, or None if it is not done yet"""
+        graph = self._graph
+        nodes = graph.nodes
+        # Graph.get_or_create, inlined
+        if dep_key not in nodes:
+            nodes[dep_key] = _PENDING
+            graph.reverse_deps[dep_key] = set()
+            graph.direct_deps[dep_key] = set()
+            graph.waiting_on[dep_key] = 0
 
         # If done, return the value
-        if self._graph.is_done(dep_key):
-            return self._graph.nodes[dep_key]
-
-        # Dep not ready - register reverse edge (parent tracking)
-        if self._key not in self._graph.reverse_deps[dep_key]:
-            self._graph.reverse_deps[dep_key].add(self._key)
-            self._new_deps.append(dep_key)
+        deps = graph.direct_deps[self._key]
+        value = nodes[dep_key]
+        if (value is _PENDING and self._inline is not None
+                and dep_key not in graph.in_flight):
+            value = self._inline(dep_key)
+        if value is not _PENDING:
+            # Uncounted edge: only used to propagate invalidation
+            deps.add(dep_key)
+            graph.reverse_deps[dep_key].add(self._key)
+            return value
+
+        # Dep not ready - register reverse edge (parent tracking) once per
+        # compute(), so repeated requests don't inflate the wait count
+        if dep_key not in deps:
+            deps.add(dep_key)
+            graph.reverse_deps[dep_key].add(self._key)
+            self._new_dep_count += 1
 
             # Only enqueue if not already in-flight
-            if dep_key not in self._graph.in_flight:
-                self._graph.in_flight.add(dep_key)
+            if dep_key not in graph.in_flight:
+                graph.in_flight.add(dep_key)
                 self._queue.append(dep_key)
 
-        self._missing = True
         return None
 
-    def nodes_missing(self):
-        return self._missing
-
 
 class Executor:
     def __init__(self, functions):
         self.graph = Graph()
-        self.functions = functions  # key class name -> SkyFunction instance
-        self.queue = []
+        self.functions = functions  # key class -> SkyFunction instance
+        self.queue = deque()
+        self.trace = False  # print each scheduling step
+        # Reused across steps; inline deps get their own since they are
+        # computed while the parent's Environment is still in use
+        self._env = Environment(self.graph, self.queue, None, self._evaluate_inline)
+        self._inline_env = Environment(self.graph, self.queue, None)
 
     def evaluate(self, key):
-        self.graph.get_or_create(key)  # Initialize root key
+        root = key
+        value = self.graph.get_or_create(key)  # Initialize root key
+        if value is not None:
+            return value
         self.graph.in_flight.add(key)
         self.queue.append(key)
         step = 0
+        nodes = self.graph.nodes
+        queue = self.queue
 
-        while self.queue:
-            key = self.queue.pop(0)
+        while queue:
+            key = queue.popleft()
             step += 1
 
-            if self.graph.is_done(key):
-                print(f"[{step}] {key} -> cached")
+            if nodes[key] is not _PENDING:
+                if self.trace:
+                    print(f"[{step}] {key} -> cached")
                 continue
 
-            print(f"[{step}] {key}")
+            if self.trace:
+                print(f"[{step}] {key}")
 
-            env = Environment(self.graph, self.queue, key)
-            func = self.functions[type(key).__name__]
-            result = func.compute(key, env)
+            env = self._env
+            result = self._compute(key, env)
 
             if result is not None:
-                self.graph.nodes[key] = result
-                self.graph.in_flight.discard(key)
-                print(f"      done: {result}")
-                # Signal parents
-                for parent in self.graph.reverse_deps[key]:
-                    self.graph.waiting_on[parent] -= 1
-                    remaining = self.graph.waiting_on[parent]
-                    print(f"      signal {parent} ({remaining} remaining)")
-                    if remaining == 0:
-                        print(f"      -> re-enqueue {parent}")
-                        self.queue.append(parent)
+                self._complete(key, result)
             else:
-                self.graph.waiting_on[key] = len(env._new_deps)
-                print(f"      waiting on {len(env._new_deps)} deps: {env._new_deps}")
-
-        return self.graph.nodes.get(key)
+                self._wait(key, env)
+
+        value = nodes[root]
+        return None if value is _PENDING else value
+
+    def invalidate(self, key):
+        """Marks a changed key and everything depending on it as not done"""
+        graph = self.graph
+        nodes = graph.nodes
+        if key not in nodes:
+            return
+
+        dirty = [key]
+        seen = {key}
+        for k in dirty:
+            for parent in graph.reverse_deps[k]:
+                if parent not in seen:
+                    seen.add(parent)
+                    dirty.append(parent)
+
+        # Snapshot each built dependent against its deps' current values so
+        # it can skip compute() if they come back unchanged. The key's own
+        # value changed, so it gets no memo entry.
+        for k in dirty[1:]:
+            value = nodes[k]
+            if value is not _PENDING:
+                graph.memo[k] = (value, tuple(
+                    (dep, nodes[dep]) for dep in graph.direct_deps[k]))
+        graph.memo.pop(key, None)
+
+        for k in dirty:
+            nodes[k] = _PENDING
+            graph.waiting_on[k] = 0
+            graph.in_flight.discard(k)
+            # Edges are re-registered when k is recomputed (or reused)
+            for dep in graph.direct_deps[k]:
+                graph.reverse_deps[dep].discard(k)
+
+    def _evaluate_inline(self, key):
+        """Evaluates a pending, not-in-flight dep in place (one level)"""
+        # A dep that completes here spares its parent a restart; otherwise it
+        # becomes a waiting node. Its own Environment has no inline hook, so
+        # this never recurses further.
+        if self.trace:
+            print(f"      inline {key}")
+        self.graph.in_flight.add(key)
+        env = self._inline_env
+        result = self._compute(key, env)
+
+        if result is not None:
+            self._complete(key, result)
+        else:
+            self._wait(key, env)
+        return self.graph.nodes[key]
+
+    def _compute(self, key, env):
+        graph = self.graph
+        env.reset(key)
+        # Skip compute() while every dep still has the value it was built from
+        memo = graph.memo.get(key)
+        if memo is not None:
+            value, fingerprint = memo
+            nodes = graph.nodes
+            pending = []
+            for dep, dep_value in fingerprint:
+                current = nodes[dep]
+                if current is _PENDING:
+                    pending.append(dep)
+                elif current != dep_value:
+                    del graph.memo[key]  # a dep changed; can never match again
+                    break
+            else:
+                # Restore the memoized dep set, which an aborted restart may
+                # have left partial
+                deps = self._reset_deps(key)
+                deps.update(dep for dep, _ in fingerprint)
+                reverse_deps = graph.reverse_deps
+                for dep in deps:
+                    reverse_deps[dep].add(key)
+
+                if not pending:
+                    del graph.memo[key]
+                    if self.trace:
+                        print("      deps unchanged, reusing value")
+                    return value
+
+                # Bring dirty deps up to date before deciding to compute()
+                if self.trace:
+                    print("      checking memoized deps")
+                in_flight = graph.in_flight
+                for dep in pending:
+                    if dep not in in_flight:
+                        in_flight.add(dep)
+                        self.queue.append(dep)
+                env._new_dep_count = len(pending)
+                return None
+
+        # Restart: deps are re-requested from scratch; compute() re-registers
+        # the edges it still needs
+        self._reset_deps(key)
+        return self.functions[type(key)].compute(key, env)
+
+    def _reset_deps(self, key):
+        """Detaches key from its previous deps and returns its emptied dep set"""
+        deps = self.graph.direct_deps[key]
+        reverse_deps = self.graph.reverse_deps
+        for dep in deps:
+            reverse_deps[dep].discard(key)
+        deps.clear()
+        return deps
+
+    def _wait(self, key, env):
+        self.graph.waiting_on[key] = env._new_dep_count
+        if self.trace:
+            # direct_deps is a set; sort so the trace is stable across runs
+            pending = sorted((dep for dep in self.graph.direct_deps[key]
+                              if self.graph.nodes[dep] is _PENDING), key=repr)
+            print(f"      waiting on {env._new_dep_count} deps: {pending}")
+
+    def _complete(self, key, result):
+        nodes = self.graph.nodes
+        nodes[key] = result
+        self.graph.in_flight.discard(key)
+        if self.trace:
+            print(f"      done: {result}")
+        # Signal parents
+        waiting_on = self.graph.waiting_on
+        enqueue = self.queue.append
+        for parent in self.graph.reverse_deps[key]:
+            remaining = waiting_on[parent] - 1
+            waiting_on[parent] = remaining
+            if self.trace:
+                print(f"      signal {parent} ({remaining} remaining)")
+            if remaining == 0 and nodes[parent] is _PENDING:
+                if self.trace:
+                    print(f"      -> re-enqueue {parent}")
+                enqueue(parent)
 
 # ============================================================================
-# SkyKeys - just identifiers (immutable, hashable)
+# SkyKeys - just identifiers (immutable, hashable, interned)
 # ============================================================================
 
 class FileStateKey:
-    def __init__(self, path):
-        self.path = path
+    __slots__ = ("path", "_hash")
+    _pool = {}  # path -> interned key
+
+    def __new__(cls, path):
+        key = cls._pool.get(path)
+        if key is None:
+            key = super().__new__(cls)
+            key.path = path
+            key._hash = hash(("FileState", path))
+            cls._pool[path] = key
+        return key
+
+    def __getnewargs__(self):
+        # pickle/copy re-create keys through __new__, i.e. via the pool
+        return (self.path,)
 
     def __hash__(self):
-        return hash(("FileState", self.path))
+        return self._hash
 
     def __eq__(self, other):
         return isinstance(other, FileStateKey) and self.path == other.path
@@ -120,11 +297,26 @@ class FileStateKey:
 
 
 class FileKey:
-    def __init__(self, path):
-        self.path = path
+    __slots__ = ("path", "parent", "_hash")
+    _pool = {}  # path -> interned key
+
+    def __new__(cls, path):
+        key = cls._pool.get(path)
+        if key is None:
+            key = super().__new__(cls)
+            key.path = path
+            # Parent directory path, or None if this is a directory
+            key.parent = (None if path.endswith("/")
+                          else "/".join(path.split("/")[:-1]) + "/")
+            key._hash = hash(("File", path))
+            cls._pool[path] = key
+        return key
+
+    def __getnewargs__(self):
+        return (self.path,)
 
     def __hash__(self):
-        return hash(("File", self.path))
+        return self._hash
 
     def __eq__(self, other):
         return isinstance(other, FileKey) and self.path == other.path
@@ -134,11 +326,23 @@ class FileKey:
 
 
 class ArtifactKey:
-    def __init__(self, path):
-        self.path = path
+    __slots__ = ("path", "_hash")
+    _pool = {}  # path -> interned key
+
+    def __new__(cls, path):
+        key = cls._pool.get(path)
+        if key is None:
+            key = super().__new__(cls)
+            key.path = path
+            key._hash = hash(("Artifact", path))
+            cls._pool[path] = key
+        return key
+
+    def __getnewargs__(self):
+        return (self.path,)
 
     def __hash__(self):
-        return hash(("Artifact", self.path))
+        return self._hash
 
     def __eq__(self, other):
         return isinstance(other, ArtifactKey) and self.path == other.path
@@ -148,11 +352,23 @@ class ArtifactKey:
 
 
 class ArtifactNestedSetKey:
-    def __init__(self, n):
-        self.n = n
+    __slots__ = ("n", "_hash")
+    _pool = {}  # n -> interned key
+
+    def __new__(cls, n):
+        key = cls._pool.get(n)
+        if key is None:
+            key = super().__new__(cls)
+            key.n = n
+            key._hash = hash(("ArtifactNestedSet", n))
+            cls._pool[n] = key
+        return key
+
+    def __getnewargs__(self):
+        return (self.n,)
 
     def __hash__(self):
-        return hash(("ArtifactNestedSet", self.n))
+        return self._hash
 
     def __eq__(self, other):
         return isinstance(other, ArtifactNestedSetKey) and self.n == other.n
@@ -176,14 +392,14 @@ class FileFunction:
     """Resolves a file, checking parent directory first"""
     def compute(self, key, env):
         # If not a directory, depend on parent dir first
-        if not key.path.endswith("/"):
-            parent_path = "/".join(key.path.split("/")[:-1]) + "/"
-            env.get_value(FileKey(parent_path))
+        parent_dir = None
+        if key.parent is not None:
+            parent_dir = env.get_value(FileKey(key.parent))
 
         # Depend on file state
         state = env.get_value(FileStateKey(key.path))
 
-        if env.nodes_missing():
+        if state is None or (key.parent is not None and parent_dir is None):
             return None
 
         return f"File[{state}]"
@@ -194,7 +410,7 @@ class ArtifactFunction:
     def compute(self, key, env):
         file_val = env.get_value(FileKey(f"/workspace/{key.path}"))
 
-        if env.nodes_missing():
+        if file_val is None:
             return None
 
         return f"Artifact({file_val})"
@@ -207,7 +423,7 @@ class ArtifactNestedSetFunction:
         a1 = env.get_value(ArtifactKey("hello.py"))
         a2 = env.get_value(ArtifactKey("lib.py"))
 
-        if env.nodes_missing():
+        if a1 is None or a2 is None:
             return None
 
         return f"NestedSet{{{a1}, {a2}}}"
@@ -220,10 +436,10 @@ class ArtifactNestedSetFunction:
 if __name__ == "__main__":
     # Register functions (singleton per key type)
     functions = {
-        "FileStateKey": FileStateFunction(),
-        "FileKey": FileFunction(),
-        "ArtifactKey": ArtifactFunction(),
-        "ArtifactNestedSetKey": ArtifactNestedSetFunction(),
+        FileStateKey: FileStateFunction(),
+        FileKey: FileFunction(),
+        ArtifactKey: ArtifactFunction(),
+        ArtifactNestedSetKey: ArtifactNestedSetFunction(),
     }
 
     print("=" * 60)
@@ -231,6 +447,14 @@ if __name__ == "__main__":
     print("=" * 60)
 
     executor = Executor(functions)
+    executor.trace = True
+    result = executor.evaluate(ArtifactNestedSetKey(2))
+
+    print("\n" + "=" * 60)
+    print("Invalidating FILE_STATE:/workspace/lib.py and re-evaluating")
+    print("=" * 60)
+
+    executor.invalidate(FileStateKey("/workspace/lib.py"))
     result = executor.evaluate(ArtifactNestedSetKey(2))
 
     print("\nGraph contents:")